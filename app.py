@@ -1,48 +1,207 @@
-import random
+import functools
+import io
+import uuid
+
+import numpy as np
 import streamlit as st
-import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
 import pandas as pd
 
 # ============================================================
 # 基本関数
 # ============================================================
-def make_initial_population(N, p00, p01, p11, rng):
+def initial_genotype_counts(N, p00, p01, p11, rng):
     """
-    N個体の二倍体集団を作る
-    [0,0], [0,1], [1,1] の割合で初期化（端数は自動調整）
+    [0,0], [0,1], [1,1] の個体数を多項分布で決める
+    割合は合計が1になるよう正規化して使う（合計は0より大きいこと）
+    """
+    probs = np.array([p00, p01, p11], dtype=float)
+    return rng.multinomial(N, probs / probs.sum())
+
+
+def initial_counts(genotype_counts):
+    """初期集団の対立遺伝子0の個数（2N 個のアレル中）"""
+    n00, n01, _ = genotype_counts
+    return 2 * n00 + n01
+
+
+def next_counts(counts, n_alleles, rng):
+    """
+    次世代の対立遺伝子0の個数（Wright–Fisher型・二項分布）
+    選択・突然変異がなければ頻度は 0 の個数だけで決まるので、
+    k' ~ Binomial(2N, k / 2N) で全反復をまとめて1世代進める
     """
-    n00 = int(N * p00)
-    n01 = int(N * p01)
-    n11 = N - n00 - n01  # 端数調整
+    return rng.binomial(n_alleles, counts / n_alleles)
 
-    pop = []
-    pop.extend([[0, 0]] * n00)
-    pop.extend([[0, 1]] * n01)
-    pop.extend([[1, 1]] * n11)
 
-    rng.shuffle(pop)
+# ------------------------------------------------------------
+# 個体（遺伝子型）レベルのモデル
+# ------------------------------------------------------------
+# 集団は長さ 2N の uint8 配列（アレルプール）で表す。
+# 個体 i の遺伝子型は pop[2*i], pop[2*i + 1] の2アレル。
+def make_initial_population(genotype_counts, rng):
+    """
+    N個体の二倍体集団を作る
+    genotype_counts は initial_genotype_counts() の [0,0], [0,1], [1,1] の個体数
+    """
+    n00, n01, n11 = genotype_counts
+    N = n00 + n01 + n11
+
+    # 1つの配列にスライスで書き込む（ヘテロは偶数番目が0・奇数番目が1）
+    pop = np.empty(2 * N, dtype=np.uint8)
+    pop[:2 * n00] = 0
+    pop[2 * n00:2 * (n00 + n01):2] = 0
+    pop[2 * n00 + 1:2 * (n00 + n01):2] = 1
+    pop[2 * (n00 + n01):] = 1
+
+    # 個体単位で並べ替え（遺伝子型の組は保つ）
+    rng.shuffle(pop.reshape(N, 2))
     return pop
 
 
-def generate_next(population, rng):
+def generate_next(populations, rng, kernel=None):
     """
     次世代を作る（Wright–Fisher型）
     各子個体はランダムに選ばれた2親から1アレルずつ受け取る
+    populations は (反復数, 2N) の配列で、全反復を同時に1世代進める
+    kernel に load_numba_kernel() の結果を渡すとそちらで計算する
     """
-    next_pop = []
-    for _ in range(len(population)):
-        p1, p2 = rng.sample(population, 2)
-        a1 = rng.choice(p1)
-        a2 = rng.choice(p2)
-        next_pop.append([a1, a2])
-    return next_pop
+    if kernel is not None:
+        # Numba 側の乱数は rng から引いたシードで決める。
+        # 乱数列は NumPy 版と別物なので、同じシードでも Numba の有無で結果が変わる
+        # （再現できるのは同じ環境の中だけ）
+        return kernel(populations, int(rng.integers(2**31)))
+
+    n_rep, n_alleles = populations.shape
+    idx = draw_parent_alleles(n_rep, n_alleles // 2, rng)
+    return np.take_along_axis(populations, idx, axis=1)
+
+
+def draw_parent_alleles(n_rep, N, rng):
+    """
+    子の2N個のアレルそれぞれが、親集団のどのアレルを受け継ぐか（添字）
+    戻り値は (反復数, 2N)。子 i の2アレルは別々の親から来る
+    """
+    # 2親は別個体：2番目の親は残り N-1 個体から一様に選ぶ
+    # （0..N-2 を引き、1番目の親以上なら1つずらす。引き直し不要）
+    parents = np.empty((n_rep, N, 2), dtype=np.int64)
+    parents[..., 0] = rng.integers(0, N, size=(n_rep, N))
+    parents[..., 1] = rng.integers(0, N - 1, size=(n_rep, N))
+    parents[..., 1] += parents[..., 1] >= parents[..., 0]
+
+    # 各親から2アレルのどちらか一方を受け取る
+    parents *= 2
+    parents += rng.integers(0, 2, size=(n_rep, N, 2))
+    return parents.reshape(n_rep, 2 * N)
+
+
+@st.cache_resource
+def load_numba_kernel():
+    """
+    generate_next の Numba 版（インデックス配列を作らないので大きな N で省メモリ）
+    Numba はオプション。入っていなければ None を返し NumPy 版を使う
+    ※ NumPy 版とは乱数の使い方が違うため、個体レベルの結果は Numba の有無で異なる
+    """
+    try:
+        from numba import njit
+    except ImportError:
+        return None
+
+    @njit
+    def kernel(populations, seed):
+        np.random.seed(seed)
+        n_rep, n_alleles = populations.shape
+        N = n_alleles // 2
+        next_pops = np.empty_like(populations)
+        for r in range(n_rep):
+            for i in range(N):
+                p1 = np.random.randint(0, N)
+                p2 = np.random.randint(0, N - 1)
+                if p2 >= p1:
+                    p2 += 1
+                next_pops[r, 2 * i] = populations[r, 2 * p1 + np.random.randint(0, 2)]
+                next_pops[r, 2 * i + 1] = populations[r, 2 * p2 + np.random.randint(0, 2)]
+        return next_pops
+
+    # 初回のコンパイルをここで済ませる（サーバープロセスごとに1回）
+    kernel(np.zeros((1, 4), dtype=np.uint8), 0)
+    return kernel
 
 
 def calc_freq0(population):
-    """対立遺伝子0の頻度（0の個数 / 全アレル数）"""
-    total = 2 * len(population)
-    n0 = sum(1 for g in population for a in g if a == 0)
-    return n0 / total
+    """
+    対立遺伝子0の頻度（0の個数 / 全アレル数）
+    (反復数, 2N) の配列を渡すと反復ごとの頻度をまとめて返す
+    """
+    return np.count_nonzero(population == 0, axis=-1) / population.shape[-1]
+
+
+def reserve_history(history, n_cols):
+    """
+    頻度履歴 history[rep][gen] の列数を n_cols 以上にする
+    不足するときだけ容量を倍に広げてコピーする（追記ごとの再確保を避ける）
+    """
+    n_rep, capacity = history.shape
+    if n_cols <= capacity:
+        return history
+    grown = np.empty((n_rep, max(n_cols, 2 * capacity)), dtype=history.dtype)
+    grown[:, :capacity] = history
+    return grown
+
+
+# ------------------------------------------------------------
+# 表示用データ（履歴が変わらない再実行ではキャッシュを返す）
+# ------------------------------------------------------------
+# キャッシュのキーは (セッションID, 履歴の版数) だけにする。
+# 先頭が _ の引数は Streamlit がハッシュしないので、配列全体の走査も省ける。
+@st.cache_data(max_entries=32)
+def build_long_df(key, _history):
+    """
+    頻度履歴 history[rep][gen] を積み上げ形式（世代 × 反復）の表にする
+    """
+    n_rep, n_gen = _history.shape
+
+    # 世代順・反復順に並んだ状態で直接作る（melt / sort 不要）
+    return pd.DataFrame({
+        "generation": np.repeat(np.arange(n_gen), n_rep),
+        "replicate": np.tile(np.arange(1, n_rep + 1), n_gen),
+        "allele0_freq": _history.T.reshape(-1),
+    })
+
+
+@st.cache_resource(max_entries=32)
+def render_plot(key, _history):
+    """
+    頻度推移のグラフを PNG のバイト列で返す（全反復を1つの LineCollection で描く）
+    描画済みの画像をキャッシュするので、再実行では Figure の作成も描画も省ける
+    """
+    n_rep, n_gen = _history.shape
+    x = np.broadcast_to(np.arange(n_gen), _history.shape)
+    segments = np.stack([x, _history], axis=-1)  # (反復数, 世代数, 2)
+
+    # pyplot を通さずに作るので、図がグローバルに登録されず閉じ忘れもない
+    fig = Figure(figsize=(8, 3), dpi=120)
+    ax = fig.subplots()
+    ax.add_collection(LineCollection(
+        segments, colors=[f"C{i % 10}" for i in range(n_rep)], alpha=0.9
+    ))
+
+    ax.set_xlabel("Generation")
+    ax.set_ylabel("Allele-0 frequency")
+    ax.set_xlim(0, max(n_gen - 1, 1))
+    ax.set_ylim(0, 1)
+    ax.set_title("Genetic drift (10 replicates, +10 generations per step)")
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=200, bbox_inches="tight")
+    return buf.getvalue()
+
+
+@st.cache_data(max_entries=32)
+def to_csv_bytes(key, _df):
+    """CSV（UTF-8）のバイト列"""
+    return _df.to_csv(index=False).encode("utf-8")
 
 
 # ============================================================
@@ -82,6 +241,20 @@ with st.sidebar:
     p01 = st.number_input("[0,1]", 0.0, 1.0, 0.40)
     p11 = st.number_input("[1,1]", 0.0, 1.0, 0.10)
 
+    p_total = p00 + p01 + p11
+    if p_total == 0:
+        st.error("割合の合計が0です。どれかを0より大きくしてください。")
+    elif abs(p_total - 1) > 0.01:
+        st.warning(f"割合の合計が {p_total:.2f} です。合計が1になるよう正規化して使います。")
+
+    genotype_mode = st.checkbox(
+        "個体（遺伝子型）レベルで計算",
+        value=False,
+        help="オフ: 対立遺伝子0の個数だけを二項分布で更新する（高速）。"
+             "頻度の振る舞いは個体レベルの計算とほぼ同じ。"
+             "オン: Numba が入っている環境では同じシードでも結果が変わる。",
+    )
+
     # ===== 解説（サイドバーに常駐）=====
     st.markdown("---")
     st.markdown("### 📘 モデルの考え方（解説）")
@@ -135,99 +308,133 @@ with st.sidebar:
 """)
 
 replicates = 10  # ★ 固定で10反復
+table_gens = 20  # 表に表示する世代数（最新から。全世代はCSVで）
 
 # ------------------------------------------------------------
 # session_state 初期化
 # ------------------------------------------------------------
+if "counts" not in st.session_state:
+    st.session_state.counts = None  # 反復ごとの対立遺伝子0の個数
+
 if "populations" not in st.session_state:
-    st.session_state.populations = []
+    st.session_state.populations = None  # (反復数, 2N) の uint8 配列（個体レベル時のみ）
+
+if "n_alleles" not in st.session_state:
+    st.session_state.n_alleles = 0  # 初期化時の 2N
 
 if "freq_history" not in st.session_state:
-    st.session_state.freq_history = []  # freq_history[rep][gen]
+    # freq_history[rep][gen]、有効なのは先頭 generation + 1 列
+    st.session_state.freq_history = None
 
 if "generation" not in st.session_state:
     st.session_state.generation = 0
 
-# 乱数生成器
-rng = random.Random(seed)
+# 表示用キャッシュのキー（初期化・世代更新のたびに version を進める）
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
+if "version" not in st.session_state:
+    st.session_state.version = 0
 
 # ------------------------------------------------------------
 # 操作ボタン
 # ------------------------------------------------------------
 col1, col2 = st.columns(2)
-init_btn = col1.button("🟩 初期化（反復10回）", use_container_width=True)
-step_btn = col2.button("➡️ 次の世代へ（+10世代）", use_container_width=True)
+init_btn = col1.button(
+    "🟩 初期化（反復10回）", width="stretch", disabled=p_total == 0
+)
+step_btn = col2.button("➡️ 次の世代へ（+10世代）", width="stretch")
+
+# 乱数生成器（NumPy Generator / PCG64）
+# ※ random.Random から切り替えたため、同じシードでも以前とは結果が異なる
+# 再実行ごとに作り直すと毎回同じ乱数列になるので session_state に保持し、
+# 初期化時とシード変更時だけ作り直す
+if init_btn or "rng" not in st.session_state or st.session_state.seed != seed:
+    st.session_state.rng = np.random.default_rng(int(seed))
+    st.session_state.seed = seed
+rng = st.session_state.rng
 
 # ------------------------------------------------------------
 # 初期化処理
 # ------------------------------------------------------------
 if init_btn:
-    st.session_state.populations = []
-    st.session_state.freq_history = []
+    n_alleles = 2 * N
+    # 初期の遺伝子型の個体数は1回だけ引き、全反復で共通にする
+    genotype_counts = initial_genotype_counts(N, p00, p01, p11, rng)
+    counts = np.full(replicates, initial_counts(genotype_counts))
+    if genotype_mode:
+        st.session_state.populations = np.stack([
+            make_initial_population(genotype_counts, rng)
+            for _ in range(replicates)
+        ])
+        st.session_state.counts = None
+    else:
+        st.session_state.populations = None
+        st.session_state.counts = counts
+    st.session_state.n_alleles = n_alleles
+    history = np.empty((replicates, 64))
+    history[:, 0] = counts / n_alleles
+    st.session_state.freq_history = history
     st.session_state.generation = 0
-
-    for _ in range(replicates):
-        pop = make_initial_population(N, p00, p01, p11, rng)
-        st.session_state.populations.append(pop)
-        st.session_state.freq_history.append([calc_freq0(pop)])
+    st.session_state.version += 1
 
 # ------------------------------------------------------------
 # 10世代まとめて進める（全反復）
 # ------------------------------------------------------------
-if step_btn and st.session_state.populations:
-    for _ in range(10):
-        for i in range(replicates):
-            st.session_state.populations[i] = generate_next(
-                st.session_state.populations[i], rng
-            )
-            st.session_state.freq_history[i].append(
-                calc_freq0(st.session_state.populations[i])
-            )
-        st.session_state.generation += 1
+if step_btn and st.session_state.freq_history is not None:
+    n_alleles = st.session_state.n_alleles
+    counts = st.session_state.counts
+    pops = st.session_state.populations
+    kernel = load_numba_kernel() if pops is not None else None
+    gen = st.session_state.generation
+    history = reserve_history(st.session_state.freq_history, gen + 11)
+    for g in range(gen + 1, gen + 11):
+        if pops is None:
+            counts = next_counts(counts, n_alleles, rng)
+            history[:, g] = counts / n_alleles
+        else:
+            pops = generate_next(pops, rng, kernel)
+            history[:, g] = calc_freq0(pops)
+
+    st.session_state.counts = counts
+    st.session_state.populations = pops
+    st.session_state.freq_history = history
+    st.session_state.generation = gen + 10
+    st.session_state.version += 1
 
 # ------------------------------------------------------------
 # 表示
 # ------------------------------------------------------------
-if not st.session_state.populations:
+if st.session_state.freq_history is None:
     st.info("「初期化（反復10回）」を押してください。")
     st.stop()
 
+history = st.session_state.freq_history[:, :st.session_state.generation + 1]
+cache_key = (st.session_state.session_id, st.session_state.version)
+
 st.metric("現在の世代", st.session_state.generation)
 
 # ===== グラフ =====
 st.markdown("### 対立遺伝子0の頻度推移（反復10回）")
 
-fig, ax = plt.subplots(figsize=(8, 3), dpi=120)
-for freq in st.session_state.freq_history:
-    ax.plot(range(len(freq)), freq, alpha=0.9)
-
-ax.set_xlabel("Generation")
-ax.set_ylabel("Allele-0 frequency")
-ax.set_ylim(0, 1)
-ax.set_title("Genetic drift (10 replicates, +10 generations per step)")
-st.pyplot(fig)
+st.image(render_plot(cache_key, history), width="stretch")
 
 # ===== テーブル（積み上げ / long）=====
 st.markdown("### 0アレル頻度テーブル（積み上げ：世代 × 反復）")
 
-# wide → long 変換
-df_wide = pd.DataFrame(
-    {f"rep_{i+1}": freq for i, freq in enumerate(st.session_state.freq_history)}
-)
-df_wide.insert(0, "generation", df_wide.index)
-
-df_long = df_wide.melt(
-    id_vars=["generation"],
-    var_name="replicate",
-    value_name="allele0_freq"
-).sort_values(["generation", "replicate"]).reset_index(drop=True)
+df_long = build_long_df(cache_key, history)
 
-st.dataframe(df_long, use_container_width=True, height=450)
+# ブラウザへ送るのは最新の世代分だけ（全データはCSVに入る）
+n_rows = table_gens * replicates
+if len(df_long) > n_rows:
+    st.caption(f"最新 {table_gens} 世代分を表示しています。全世代はCSVでダウンロードできます。")
+st.dataframe(df_long.tail(n_rows), width="stretch", height=450)
 
 # ===== CSV ダウンロード（long版）=====
+# CSV はボタンが押されたときに作る（関数を渡すと Streamlit が遅延実行する）
 st.download_button(
     "📥 CSVでダウンロード（積み上げ形式）",
-    df_long.to_csv(index=False).encode("utf-8"),
+    functools.partial(to_csv_bytes, cache_key, df_long),
     file_name="allele0_frequency_table_long.csv",
     mime="text/csv"
 )